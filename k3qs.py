@@ -1,14 +1,83 @@
 import streamlit as st
 import random
-from openai import OpenAI
+import numpy as np
+from openai import (OpenAI, AsyncOpenAI, APIConnectionError, AuthenticationError, PermissionDeniedError,
+                    RateLimitError, InternalServerError)
 import threading
-import io
+import asyncio
+import httpx
+from collections import deque
+import re
 import time
+import os
+import json
+import hashlib
+import sqlite3
 
 # --- Core Quiz Logic (Thread-Safe) ---
 
 MODEL = "sonar-pro"
 
+# Persistent sentence cache, shared across sessions and users of this app.
+CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "k3qs_cache.sqlite3")
+CACHE_VARIANTS = 3  # Sentences kept per verb; once full, repeat verbs are served from disk.
+
+PREFETCH_DEPTH = 3  # Questions prepared ahead of the one on screen.
+BATCH_SIZE = 10  # Verbs whose sentences are requested together in one API call.
+SENTENCE_MAX_TOKENS = 80  # Room for one sentence, the separator and its translation.
+API_TIMEOUT = 8.0  # Total seconds per single-verb attempt, so a hung endpoint cannot stall the quiz.
+API_ATTEMPTS = 2
+KEY_CHECK_TTL = 600  # Seconds a key probe's verdict is reused before the key is checked again.
+API_BACKOFF = 1.0  # Seconds before the first retry, doubled for each further one.
+BATCH_API_TIMEOUT = 20.0  # A batch writes BATCH_SIZE sentences; on failure verbs fall back to single calls.
+# Worth another attempt after a backoff: throttling (429) and server errors (5xx), which the
+# SDK would retry itself if its own retries were not turned off. The SDK only wraps errors raised
+# while sending the request; once a stream is open, stalls and dropped connections surface as
+# raw httpx errors. TimeoutError (asyncio's too) is raised by the total deadlines below.
+RETRYABLE_ERRORS = (RateLimitError, InternalServerError, APIConnectionError, httpx.TransportError,
+                    TimeoutError, asyncio.TimeoutError)
+
+# Hand-checked sentences for common verbs: {verb: [german_sentence, english_translation]}.
+# These never touch the API.
+SENTENCES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sentences.json")
+
+
+@st.cache_resource
+def load_sentence_bank():
+    """
+    Reads sentences.json once per process rather than on every rerun. Returns {verb: (german, english)};
+    a missing or broken file just means every verb is generated. Shared, so callers must not modify it.
+    """
+    try:
+        with open(SENTENCES_PATH, encoding="utf-8") as f:
+            return {verb: tuple(pair) for verb, pair in json.load(f).items()}
+    except (OSError, ValueError):
+        return {}
+
+
+BUNDLED_SENTENCES = load_sentence_bank()
+
+# "verb [translation]" lines; anything after the closing bracket is ignored.
+# Whitespace is matched as [^\S\n] so a non-breaking space is trimmed like any other.
+_VERB_RE = re.compile(
+    r'^[^\S\n]*([^\s\[][^\[\n]*?)[^\S\n]*\[[^\S\n]*([^\s\]][^\]\n]*?)[^\S\n]*\]', re.MULTILINE
+)
+
+# Prompts are built once here; per call only the verb slot is filled in.
+_SYSTEM_MSG = {"role": "system", "content": "You are a text generation API. Output only what is asked, with no commentary."}
+_USER_TMPL = (
+    "Write one A2-level German sentence using the verb '{}'. Pick a random structure: "
+    "subordinate clause, relative clause, 'zu' infinitive, modal verb, Perfekt/Präteritum or Futur I.\n"
+    "Output exactly three lines: the German sentence, then '|||', then the English translation. Nothing else."
+)
+_BATCH_USER_TMPL = (
+    "Write one A2-level German sentence for each verb in {}, varying the structure: "
+    "subordinate clause, relative clause, 'zu' infinitive, modal verb, Perfekt/Präteritum, Futur I.\n"
+    "Output only a JSON object mapping each verb, spelled as given, to [\"German sentence\", \"English translation\"]."
+)
+# Batch answers are cached under the single-verb key, so only the single-verb prompt versions the cache.
+_PROMPT_HASH = hashlib.sha1(f"{_SYSTEM_MSG['content']}|{_USER_TMPL}".encode("utf-8")).hexdigest()
+
 
 def apply_custom_css():
     """Applies custom CSS to enlarge fonts for better readability."""
@@ -23,32 +92,25 @@ def apply_custom_css():
     """, unsafe_allow_html=True)
 
 
-def load_verbs(uploaded_file):
+@st.cache_data(show_spinner=False)
+def load_verbs(file_bytes):
     """
-    Load verbs from an uploaded file.
+    Load verbs from the contents of an uploaded file.
     NEW: Also checks the first line for an API key.
+    Memoized on the file bytes, so re-uploading the same file skips parsing.
     Returns: A tuple (list_of_verbs, api_key_or_none)
     """
     try:
-        stringio = io.StringIO(uploaded_file.getvalue().decode("utf-8"))
-        lines = stringio.readlines()
+        text = file_bytes.decode("utf-8")
         api_key_from_file = None
-        start_processing_index = 0
-
-        if lines:
-            # Check if the first line looks like a Perplexity API key
-            first_line = lines[0].strip()
-            if first_line.startswith("pplx-") and '[' not in first_line:
-                api_key_from_file = first_line
-                start_processing_index = 1  # Start reading verbs from the next line
-
-        verbs = []
-        # Process only the lines that contain verbs
-        for line in lines[start_processing_index:]:
-            if '[' in line and ']' in line:
-                verb, translation = line.split('[', 1)
-                translation = translation.split(']')[0].strip()
-                verbs.append({"Verb": verb.strip(), "Translation": translation})
+
+        # Check if the first line looks like a Perplexity API key.
+        # It has no '[', so the verb pattern below skips it anyway.
+        first_line = text.split('\n', 1)[0].strip()
+        if first_line.startswith("pplx-") and '[' not in first_line:
+            api_key_from_file = first_line
+
+        verbs = [{"Verb": m.group(1), "Translation": m.group(2)} for m in _VERB_RE.finditer(text)]
 
         return verbs, api_key_from_file
 
@@ -57,80 +119,390 @@ def load_verbs(uploaded_file):
         return None, None
 
 
-# The generate_context_sentence, prepare_question_data, and worker_prepare_question functions
-# remain exactly the same as the last version. No changes are needed there.
-def generate_context_sentence(verb, api_key):
+@st.cache_resource
+def get_client(api_key):
     """
-    API call function. Gets a German sentence and its English translation
-    with high variance and WITHOUT any extra text or reasoning.
-    Returns: (german_sentence, english_translation)
+    Returns the shared Perplexity client for an API key, creating it on first use.
+    Only stream_context_sentence uses it, on the MAIN THREAD, to stream the first question.
+    """
+    # Retries are handled by the callers, within their own time budget.
+    return OpenAI(api_key=api_key, base_url="https://api.perplexity.ai", max_retries=0)
+
+
+@st.cache_resource
+def get_async_client(api_key):
+    """Returns the shared async Perplexity client for an API key. Only used on the API loop."""
+    return AsyncOpenAI(api_key=api_key, base_url="https://api.perplexity.ai", max_retries=0)
+
+
+@st.cache_resource
+def get_api_loop():
+    """
+    Starts the asyncio loop that runs every background API call, for all sessions.
+    Any number of pending requests share this one thread.
+    """
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="k3qs-api-loop", daemon=True).start()
+    return loop
+
+
+def run_in_background(coro):
+    """MAIN THREAD: Schedules a coroutine on the API loop. Returns a concurrent.futures.Future."""
+    return asyncio.run_coroutine_threadsafe(coro, get_api_loop())
+
+
+async def probe_api_key(client):
+    """
+    Checks a key with a 1-token completion. Only a rejected key counts as broken:
+    timeouts and other errors are left to the per-question retries and fallbacks.
     """
-    if not api_key:
-        return "[API Key not provided]", "[Translation not available]"
     try:
-        client = OpenAI(api_key=api_key, base_url="https://api.perplexity.ai")
-
-        user_prompt_content = f"""
-I need an A2-level German example sentence for the verb '{verb}'.
-
-**Task Methodology:**
-You MUST randomly select ONE of the following grammatical structures for your sentence. Do not use the same structure every time.
-
-**Structure Menu (Choose ONE randomly):**
-1.  **A sentence with a subordinate clause:** Use conjunctions like `dass`, `obwohl`, `wenn`, `als`, or `bevor`.
-2.  **A sentence with a relative clause:** Use a relative pronoun like `der`, `die`, `das`, or `welchem`.
-3.  **A sentence with an infinitive clause with 'zu':** Use a construction like `um ... zu` or `hat vor ... zu`.
-4.  **A sentence with a modal verb:** Include `müssen`, `können`, `wollen`, `sollen`, or `dürfen`.
-5.  **A complex sentence in the Past Tense (Perfekt or Präteritum).**
-6.  **A sentence in the Future Tense (Futur I).**
-
----
-**CRITICAL OUTPUT INSTRUCTION:**
-Your entire response MUST strictly contain ONLY the following, in this exact format:
-1. The generated German sentence on the first line.
-2. The separator '|||' on the second line.
-3. The English translation on the third line.
-
-**DO NOT include the menu, your reasoning, your choice, or any other text, explanations, or meta-commentary in your output.**
-"""
-
-        messages = [
-            {"role": "system",
-             "content": "You are a silent, efficient text generation API. You follow output formatting instructions with absolute precision. You never add conversational text or explanations."},
-            {"role": "user", "content": user_prompt_content}
-        ]
-
-        response = client.chat.completions.create(
+        await asyncio.wait_for(client.chat.completions.create(
             model=MODEL,
-            messages=messages,
-            temperature=0.8
+            messages=[{"role": "user", "content": "Hi"}],
+            max_tokens=1,
+            timeout=API_TIMEOUT
+        ), API_TIMEOUT)
+    except (AuthenticationError, PermissionDeniedError):
+        return False
+    except Exception:
+        pass
+    return True
+
+
+@st.cache_resource(ttl=KEY_CHECK_TTL)
+def start_key_check(api_key):
+    """
+    MAIN THREAD: Starts the key probe on the API loop and returns its future (of a bool)
+    without waiting, so it runs alongside the first question and the prefetch.
+    Memoized per key for KEY_CHECK_TTL, so restarting a quiz does not pay for it again.
+    """
+    return run_in_background(probe_api_key(get_async_client(api_key)))
+
+
+def key_rejected(key_check):
+    """True once the key probe has finished and found the key rejected. Never waits."""
+    return key_check.done() and not key_check.cancelled() and key_check.result() is False
+
+
+@st.cache_resource
+def open_sentence_cache():
+    """
+    Opens the SQLite sentence cache once per process, for all sessions and reruns.
+    Returns (connection, lock); the lock must be held for every use of the shared connection.
+    The connection is None if the database cannot be opened, which makes every lookup a miss.
+    """
+    try:
+        conn = sqlite3.connect(CACHE_PATH, check_same_thread=False)
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS sentences ("
+            "key TEXT, variant INTEGER, german TEXT, english TEXT, created_at REAL, "
+            "PRIMARY KEY (key, variant))"
         )
+        conn.commit()
+    except sqlite3.Error:
+        conn = None
+    return conn, threading.Lock()
+
+
+# Resolved here on the script thread: background threads only ever see the shared objects.
+_cache_conn, _cache_lock = open_sentence_cache()
+
+
+def cache_lookup_many(keys):
+    """Returns {key: [(german, english), ...]} for every key, under one lock. Errors count as misses."""
+    if _cache_conn is None:
+        return {key: [] for key in keys}
+    try:
+        with _cache_lock:
+            return {
+                key: _cache_conn.execute(
+                    "SELECT german, english FROM sentences WHERE key=?", (key,)
+                ).fetchall()
+                for key in keys
+            }
+    except sqlite3.Error:
+        return {key: [] for key in keys}
+
+
+def cache_lookup(key):
+    """Returns every cached (german, english) variant for a key. Errors count as a miss."""
+    return cache_lookup_many([key])[key]
+
+
+def cache_store_many(entries):
+    """
+    Adds a variant for each (key, german, english) entry with a single commit, overwriting
+    the oldest slot of a key once CACHE_VARIANTS is reached.
+    """
+    if _cache_conn is None or not entries:
+        return
+    try:
+        with _cache_lock:
+            conn = _cache_conn
+            for key, german, english in entries:
+                (count,) = conn.execute("SELECT COUNT(*) FROM sentences WHERE key=?", (key,)).fetchone()
+                if count < CACHE_VARIANTS:
+                    variant = count
+                else:
+                    (variant,) = conn.execute(
+                        "SELECT variant FROM sentences WHERE key=? ORDER BY created_at LIMIT 1", (key,)
+                    ).fetchone()
+                conn.execute(
+                    "INSERT OR REPLACE INTO sentences VALUES (?, ?, ?, ?, ?)",
+                    (key, variant, german, english, time.time())
+                )
+            conn.commit()
+    except sqlite3.Error:
+        pass
+
+
+def cache_store(key, german, english):
+    """Adds one variant for a key; see cache_store_many."""
+    cache_store_many([(key, german, english)])
 
-        full_response = response.choices[0].message.content.strip()
 
-        if '|||' in full_response:
-            parts = full_response.split('|||')
-            german_part = parts[0].strip().split('\n')[-1]
-            english_part = parts[1].strip()
-            return german_part, english_part
+def sentence_messages(verb):
+    """Builds the chat messages asking for one example sentence for a verb."""
+    return _SYSTEM_MSG, {"role": "user", "content": _USER_TMPL.format(verb)}
+
+
+def sentence_cache_key(verb):
+    """Cache key for a verb: changing the model or the prompt starts a fresh cache entry."""
+    return hashlib.sha1(f"{MODEL}|{verb}|{_PROMPT_HASH}".encode("utf-8")).hexdigest()
+
+
+def reusable_sentence(verb, cache_key, can_generate):
+    """
+    Returns a bundled or cached (german, english) pair for a verb, or None if a new
+    sentence should be generated. Bundled sentences win; cached ones are used once a verb
+    has CACHE_VARIANTS of them, or whenever nothing new can be generated.
+    """
+    if verb in BUNDLED_SENTENCES:
+        return BUNDLED_SENTENCES[verb]
+    cached = cache_lookup(cache_key)
+    if len(cached) >= CACHE_VARIANTS or (cached and not can_generate):
+        return random.choice(cached)
+    return None
+
+
+def parse_sentence_response(full_response, cache_key):
+    """Splits a 'german ||| english' answer into its parts and caches it if well-formed."""
+    if '|||' in full_response:
+        parts = full_response.split('|||')
+        german_part = parts[0].strip().split('\n')[-1]
+        english_part = parts[1].strip()
+        # Only well-formed answers are worth keeping.
+        cache_store(cache_key, german_part, english_part)
+        return german_part, english_part
+    else:
+        return full_response, "[Translation not generated by AI]"
+
+
+def stream_german_part(response, received, deadline):
+    """
+    Yields the German sentence of a streamed answer as it arrives, holding back the
+    '|||' separator and the translation. Every chunk is still appended to received.
+    Raises TimeoutError once time.monotonic() passes deadline.
+    """
+    yield "**Context:** "
+    shown = 0
+    for chunk in response:
+        if time.monotonic() > deadline:
+            response.close()
+            raise TimeoutError("sentence stream took too long")
+        received.append((chunk.choices[0].delta.content or "") if chunk.choices else "")
+        text = "".join(received)
+        cut = text.find('|||')
+        # A trailing '|' may be the start of the separator, so it waits for the next chunk.
+        visible = text[:cut] if cut != -1 else text.rstrip('|')
+        if len(visible) > shown:
+            yield visible[shown:]
+            shown = len(visible)
+
+
+def retry_delay(attempt):
+    """Seconds to wait before the given attempt: none for the first, then exponential backoff."""
+    return API_BACKOFF * 2 ** (attempt - 1) if attempt else 0
+
+
+def fallback_sentence(verb):
+    """Placeholder used once every attempt has timed out or lost its connection."""
+    return f"({verb}) – no context available", "[Translation not available]"
+
+
+def rejected_sentence():
+    """Placeholder used once the API has refused the key."""
+    return "[API Key rejected]", "[Translation not available]"
+
+
+def stream_context_sentence(verb, api_key, key_check):
+    """
+    MAIN THREAD: Gets the first question's sentence, rendering the German part with
+    st.write_stream as it is generated. Bundled and cached sentences are returned
+    without rendering anything. key_check is the future from start_key_check.
+    Returns: (german_sentence, english_translation)
+    """
+    cache_key = sentence_cache_key(verb)
+    rejected = key_rejected(key_check)
+    known = reusable_sentence(verb, cache_key, bool(api_key) and not rejected)
+    if known:
+        return known
+
+    if not api_key:
+        return "[API Key not provided]", "[Translation not available]"
+    if rejected:
+        return rejected_sentence()
+    client = get_client(api_key)
+    for attempt in range(API_ATTEMPTS):
+        time.sleep(retry_delay(attempt))
+        try:
+            # The httpx timeout only limits each read, so a slow trickle of chunks is cut off by
+            # this deadline. A read already blocked when it passes can take one more API_TIMEOUT,
+            # so a streamed attempt is bounded by about 2 * API_TIMEOUT.
+            deadline = time.monotonic() + API_TIMEOUT
+            response = client.chat.completions.create(
+                model=MODEL,
+                messages=sentence_messages(verb),
+                temperature=0.8,
+                max_tokens=SENTENCE_MAX_TOKENS,
+                timeout=API_TIMEOUT,
+                stream=True
+            )
+            received = []
+            st.write_stream(stream_german_part(response, received, deadline))
+            return parse_sentence_response("".join(received).strip(), cache_key)
+        except RETRYABLE_ERRORS:
+            continue
+        except (AuthenticationError, PermissionDeniedError):
+            return rejected_sentence()
+        except Exception as e:
+            return f"[Sentence generation failed for '{verb}': {e}]", "[Translation not available]"
+    return fallback_sentence(verb)
+
+
+async def generate_context_sentence(verb, client, key_check):
+    """
+    API call function, run on the API loop. Gets a German sentence and its English
+    translation with high variance and WITHOUT any extra text or reasoning.
+    NEW: Bundled sentences are used first, then the persistent cache once a verb
+    has CACHE_VARIANTS sentences. RETRYABLE_ERRORS are retried up to API_ATTEMPTS times.
+    client is the AsyncOpenAI client, or None when there is no API key; key_check is the
+    future from start_key_check.
+    Returns: (german_sentence, english_translation)
+    """
+    cache_key = sentence_cache_key(verb)
+    # SQLite I/O runs in a worker thread: blocking here would stall every session's API calls.
+    rejected = key_rejected(key_check)
+    known = await asyncio.to_thread(reusable_sentence, verb, cache_key, client is not None and not rejected)
+    if known:
+        return known
+
+    if client is None:
+        return "[API Key not provided]", "[Translation not available]"
+    if rejected:
+        return rejected_sentence()
+    for attempt in range(API_ATTEMPTS):
+        await asyncio.sleep(retry_delay(attempt))
+        try:
+            # wait_for makes API_TIMEOUT a total limit; the httpx timeout alone only limits each read.
+            response = await asyncio.wait_for(client.chat.completions.create(
+                model=MODEL,
+                messages=sentence_messages(verb),
+                temperature=0.8,
+                max_tokens=SENTENCE_MAX_TOKENS,
+                timeout=API_TIMEOUT
+            ), API_TIMEOUT)
+            full_response = response.choices[0].message.content.strip()
+            return await asyncio.to_thread(parse_sentence_response, full_response, cache_key)
+        except RETRYABLE_ERRORS:
+            continue
+        except (AuthenticationError, PermissionDeniedError):
+            return rejected_sentence()
+        except Exception as e:
+            return f"[Sentence generation failed for '{verb}': {e}]", "[Translation not available]"
+    return fallback_sentence(verb)
+
+
+def batch_sentence_messages(verbs):
+    """Builds the chat messages asking for one example sentence per verb, as JSON."""
+    return _SYSTEM_MSG, {"role": "user", "content": _BATCH_USER_TMPL.format(json.dumps(verbs, ensure_ascii=False))}
+
+
+async def generate_context_sentences_batch(verbs, client, key_check):
+    """
+    Gets sentences for several verbs with a single API call. Bundled and cached verbs are not requested.
+    Returns: {verb: (german_sentence, english_translation)}. Verbs the model skipped or
+    garbled are left out, so callers fall back to generate_context_sentence for them.
+    """
+    sentences = {verb: BUNDLED_SENTENCES[verb] for verb in verbs if verb in BUNDLED_SENTENCES}
+    keys = {verb: sentence_cache_key(verb) for verb in verbs if verb not in sentences}
+    # One lookup and one commit per batch, both off the API loop.
+    cached = await asyncio.to_thread(cache_lookup_many, list(keys.values()))
+    missing = []
+    for verb, key in keys.items():
+        if len(cached[key]) >= CACHE_VARIANTS:
+            sentences[verb] = random.choice(cached[key])
         else:
-            return full_response, "[Translation not generated by AI]"
+            missing.append(verb)
+
+    if not missing or client is None or key_rejected(key_check):
+        return sentences
+    # Retried like single verbs: giving up at once on a 429 would turn one throttled batch
+    # into a single-verb request per question, just while the API is asking for less load.
+    for attempt in range(API_ATTEMPTS):
+        await asyncio.sleep(retry_delay(attempt))
+        try:
+            response = await asyncio.wait_for(client.chat.completions.create(
+                model=MODEL,
+                messages=batch_sentence_messages(missing),
+                temperature=0.8,
+                max_tokens=SENTENCE_MAX_TOKENS * len(missing),
+                timeout=BATCH_API_TIMEOUT
+            ), BATCH_API_TIMEOUT)
+            break
+        except RETRYABLE_ERRORS:
+            continue
+        except Exception:
+            return sentences  # Whatever is missing gets generated one by one instead.
+    else:
+        return sentences
 
-    except Exception as e:
-        return f"[Sentence generation failed for '{verb}': {e}]", "[Translation not available]"
-
-
-def prepare_question_data(verb_entry, all_verbs, api_key):
-    """Prepares data for one question, now including the English translation."""
-    current_verb = verb_entry["Verb"]
-    correct_translation = verb_entry["Translation"]
-    german_sentence, english_translation = generate_context_sentence(current_verb, api_key)
-    other_verbs = [v for v in all_verbs if v["Translation"] != correct_translation]
-    translations = [v["Translation"] for v in random.sample(other_verbs, 4)]
-    translations.append(correct_translation)
-    random.shuffle(translations)
+    try:
+        full_response = response.choices[0].message.content
+        # Tolerate code fences or stray text around the JSON object.
+        start, end = full_response.find('{'), full_response.rfind('}')
+        generated = json.loads(full_response[start:end + 1])
+
+        new_entries = []
+        for verb in missing:
+            pair = generated.get(verb)
+            if isinstance(pair, list) and len(pair) == 2 and all(isinstance(p, str) for p in pair):
+                german_part, english_part = pair[0].strip(), pair[1].strip()
+                new_entries.append((keys[verb], german_part, english_part))
+                sentences[verb] = (german_part, english_part)
+        await asyncio.to_thread(cache_store_many, new_entries)
+    except Exception:
+        pass  # Whatever is missing gets generated one by one instead.
+    return sentences
+
+
+def build_question(i, verb_names, all_translations, german_sentence, english_translation):
+    """Assembles question i of the deck around its context sentence, picking the answer options."""
+    correct_translation = all_translations[i]
+    # Rejection sampling: O(1) per question instead of filtering the whole deck each time.
+    # initialize_quiz guarantees at least 4 other distinct translations exist.
+    n = len(all_translations)
+    translations = []
+    while len(translations) < 4:
+        t = all_translations[random.randrange(n)]
+        if t != correct_translation and t not in translations:
+            translations.append(t)
+    # Distractors are already in random draw order; dropping the answer into a random slot
+    # gives a uniformly shuffled list without a separate shuffle pass.
+    translations.insert(random.randrange(5), correct_translation)
     return {
-        "current_verb": current_verb,
+        "current_verb": verb_names[i],
         "correct_translation": correct_translation,
         "context_sentence": german_sentence,
         "english_translation": english_translation,
@@ -138,25 +510,73 @@ def prepare_question_data(verb_entry, all_verbs, api_key):
     }
 
 
-def worker_prepare_question(verb_entry, all_verbs, api_key, result_holder):
-    """THREAD WORKER: Prepares a question. No access to st.session_state."""
-    q_data = prepare_question_data(verb_entry, all_verbs, api_key)
-    result_holder['data'] = q_data
+async def prepare_question_data(i, verb_names, all_translations, client, key_check, sentence_batch=None):
+    """
+    Prepares data for question i of the deck, now including the English translation.
+    NEW: Takes the sentence from sentence_batch (a future from generate_context_sentences_batch) if it has one.
+    """
+    current_verb = verb_names[i]
+    # Shielded: several questions share one batch, and cancelling one must not cancel it for the rest.
+    sentences = await asyncio.shield(asyncio.wrap_future(sentence_batch)) if sentence_batch else {}
+    if current_verb in sentences:
+        german_sentence, english_translation = sentences[current_verb]
+    else:
+        german_sentence, english_translation = await generate_context_sentence(current_verb, client, key_check)
+    return build_question(i, verb_names, all_translations, german_sentence, english_translation)
 
 
-def launch_next_question_job():
-    """MAIN THREAD: Starts a background job to prepare the next question."""
-    if st.session_state.unused_verbs:
-        next_verb_entry = st.session_state.unused_verbs.pop()
-        result_holder = {'data': None}
-        thread = threading.Thread(
-            target=worker_prepare_question,
-            args=(next_verb_entry, st.session_state.all_verbs, st.session_state.api_key, result_holder)
-        )
-        thread.start()
-        st.session_state.next_question_job = {'thread': thread, 'result': result_holder}
-    else:
-        st.session_state.next_question_job = None
+def sentence_batch_for(verb):
+    """
+    MAIN THREAD: Returns the batch future that covers a verb just taken from the quiz order.
+    If there is none, submits one for that verb and the next BATCH_SIZE - 1 verbs in order.
+    """
+    batches = st.session_state.sentence_batches
+    if verb not in batches:
+        verb_names = st.session_state.verb_names
+        cursor = st.session_state.cursor
+        upcoming = [verb] + [verb_names[i] for i in st.session_state.order[cursor:cursor + BATCH_SIZE - 1]]
+        future = run_in_background(generate_context_sentences_batch(
+            upcoming, background_client(), st.session_state.api_key_check
+        ))
+        # Finished batches have nothing left to cancel; dropping them also frees their results.
+        st.session_state.batch_futures = [f for f in st.session_state.batch_futures if not f.done()]
+        st.session_state.batch_futures.append(future)
+        for upcoming_verb in upcoming:
+            batches[upcoming_verb] = future
+    return batches.pop(verb)
+
+
+def background_client():
+    """MAIN THREAD: The async client for this session's API key, or None if there is no key."""
+    api_key = st.session_state.api_key
+    return get_async_client(api_key) if api_key else None
+
+
+def fill_prefetch_buffer(depth=PREFETCH_DEPTH):
+    """MAIN THREAD: Submits unused verbs until `depth` questions are pending."""
+    futures = st.session_state.prefetch_futures
+    while len(futures) < depth and st.session_state.cursor < len(st.session_state.order):
+        i = st.session_state.order[st.session_state.cursor]
+        st.session_state.cursor += 1
+        sentence_batch = sentence_batch_for(st.session_state.verb_names[i])
+        futures.append(run_in_background(prepare_question_data(
+            i, st.session_state.verb_names, st.session_state.all_translations, background_client(),
+            st.session_state.api_key_check, sentence_batch
+        )))
+
+
+def cancel_background_jobs():
+    """
+    MAIN THREAD: Cancels this session's pending questions and sentence batches.
+    Cancelling a future cancels its task on the API loop, which aborts any request in flight.
+    """
+    for future in st.session_state.get('prefetch_futures', ()):
+        future.cancel()
+    for future in st.session_state.get('batch_futures', ()):
+        future.cancel()
+    st.session_state.prefetch_futures = deque()
+    st.session_state.sentence_batches = {}
+    st.session_state.batch_futures = []
 
 
 def initialize_quiz(uploaded_file, api_key_from_ui):
@@ -164,7 +584,8 @@ def initialize_quiz(uploaded_file, api_key_from_ui):
     Sets up the initial state for the quiz.
     NEW: Prioritizes API key from the file over the UI.
     """
-    verbs, key_from_file = load_verbs(uploaded_file)
+    # Hash the raw bytes rather than the UploadedFile object, which Streamlit cannot hash reliably.
+    verbs, key_from_file = load_verbs(uploaded_file.getvalue())
 
     # Prioritize the key from the file. If it's not there, use the one from the UI.
     final_api_key = key_from_file or api_key_from_ui
@@ -174,32 +595,44 @@ def initialize_quiz(uploaded_file, api_key_from_ui):
         st.error("❗ No API Key found. Please provide it in the input box or as the first line of your file.")
         return
 
-    if not verbs or len(verbs) < 5:
-        st.error("File must contain at least 5 verbs to create multiple-choice questions.")
+    if not verbs or len({v["Translation"] for v in verbs}) < 5:
+        st.error("File must contain at least 5 verbs with different translations to create multiple-choice questions.")
         return
 
     # If a key was found in the file, give the user a confirmation message.
     if key_from_file:
         st.sidebar.success("API Key successfully loaded from file.")
 
-    random.shuffle(verbs)
-    st.session_state.all_verbs = verbs
+    # Once the probe finds the key rejected, later questions fall back at once instead of each
+    # sending a failing call. It is started, not awaited, so Q1 and the prefetch are not held up.
+    st.session_state.api_key_check = start_key_check(final_api_key)
+
+    # A quiz restarted mid-way must not keep paying for the old one's prefetches.
+    cancel_background_jobs()
+
+    # Columns instead of a list of dicts; questions refer to verbs by index.
+    st.session_state.verb_names = [v["Verb"] for v in verbs]
+    st.session_state.all_translations = [v["Translation"] for v in verbs]
     st.session_state.total_verbs = len(verbs)
-    st.session_state.unused_verbs = verbs.copy()
+    # The deck itself is never copied or reordered: questions walk a shuffled index order.
+    # NumPy builds and shuffles the int64 index array in C, which matters for very large decks.
+    st.session_state.order = np.random.default_rng().permutation(len(verbs))
     st.session_state.incorrect_answers = []
     st.session_state.question_number = 1
     st.session_state.api_key = final_api_key  # Use the decided key
     st.session_state.quiz_running = True
     st.session_state.show_feedback = False
 
-    q1_verb = st.session_state.unused_verbs.pop()
-    st.session_state.current_question_data = prepare_question_data(
-        q1_verb, st.session_state.all_verbs, st.session_state.api_key
+    q1_index = st.session_state.order[0]
+    st.session_state.cursor = 1
+    # Q1 cannot be prefetched, so its sentence is streamed by the UI instead of being
+    # waited for here. It gets its own single-verb call: a whole batch would be slower.
+    st.session_state.current_question_data = build_question(
+        q1_index, st.session_state.verb_names, st.session_state.all_translations, None, None
     )
-    launch_next_question_job()
+    fill_prefetch_buffer()
 
 
-# The handle_answer and next_question functions are unchanged.
 def handle_answer(user_choice):
     q = st.session_state.current_question_data
     st.session_state.last_answer_was_correct = (user_choice == q['correct_translation'])
@@ -208,18 +641,19 @@ def handle_answer(user_choice):
             "Verb": q['current_verb'], "Correct Translation": q['correct_translation'], "User Choice": user_choice
         })
     st.session_state.show_feedback = True
+    # The current question is done, so look one further ahead while the user reads the feedback.
+    fill_prefetch_buffer(PREFETCH_DEPTH + 1)
 
 
 def next_question():
-    job = st.session_state.next_question_job
-    if job:
+    if st.session_state.question_number < st.session_state.total_verbs:
+        # Normally instant: the buffer is kept ahead of the user.
         with st.spinner("Loading next question..."):
-            job['thread'].join()
-            result_data = job['result']['data']
+            result_data = st.session_state.prefetch_futures.popleft().result()
         st.session_state.current_question_data = result_data
         st.session_state.question_number += 1
         st.session_state.show_feedback = False
-        launch_next_question_job()
+        fill_prefetch_buffer()
 
 
 # --- Main App UI ---
@@ -242,8 +676,12 @@ with st.sidebar:
         st.rerun()
 
     if st.session_state.get('quiz_running', False):
+        # Rendered here rather than in initialize_quiz, whose output is wiped by the st.rerun() after it.
+        if key_rejected(st.session_state.api_key_check):
+            st.warning("The API key was rejected. Only built-in and cached sentences will be shown.")
         st.write("---")
         if st.button("End Quiz Now", type="secondary", use_container_width=True):
+            cancel_background_jobs()
             st.session_state.quiz_running = False
             st.rerun()
 
@@ -262,6 +700,7 @@ if not st.session_state.quiz_running:
             if st.session_state.question_number > 1 or st.session_state.show_feedback:
                 st.info("Excellent! You had no incorrect answers.")
         if st.button("Start Over"):
+            cancel_background_jobs()
             for key in list(st.session_state.keys()): del st.session_state[key]
             st.rerun()
     else:
@@ -271,7 +710,13 @@ elif st.session_state.quiz_running:
     st.progress(st.session_state.question_number / st.session_state.total_verbs,
                 text=f"Question {st.session_state.question_number} / {st.session_state.total_verbs}")
     st.subheader(f"What is the meaning of: `{q['current_verb']}`?")
-    st.markdown(f"**Context:** *{q['context_sentence']}*")
+    context_slot = st.empty()
+    if q['context_sentence'] is None:
+        with context_slot:
+            q['context_sentence'], q['english_translation'] = stream_context_sentence(
+                q['current_verb'], st.session_state.api_key, st.session_state.api_key_check
+            )
+    context_slot.markdown(f"**Context:** *{q['context_sentence']}*")
     st.write("---")
     if not st.session_state.show_feedback:
         cols = st.columns(2)
@@ -286,7 +731,7 @@ elif st.session_state.quiz_running:
             st.error(
                 f"**Incorrect.** The correct translation for `{q['current_verb']}` is **'{q['correct_translation']}'**.")
         st.info(f"**Sentence Translation:** *{q.get('english_translation', '[Not available]')}*")
-        if st.session_state.next_question_job:
+        if st.session_state.question_number < st.session_state.total_verbs:
             st.button("Next Question →", use_container_width=True, type="primary", on_click=next_question)
         else:
             if st.button("Finish Quiz", use_container_width=True, type="primary"):